@@ -1,13 +1,25 @@
 import asyncio
-import datetime
+import concurrent.futures
 import json
 import logging
 import os
-import re
 import sys
+import time
 
 import aiohttp
 import boto3
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import ClientError
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 # configure logging
 logging.basicConfig(
@@ -21,30 +33,106 @@ LOG = logging.getLogger("inStock")
 # JSON Config for products and SNS topics
 CONFIG_FILE = os.path.join(os.path.abspath(
     os.path.dirname(__file__)), 'config.json')
+# Optionally pin the process to a single CPU core (Linux only), set to the
+# core number to use
+SCRAPER_CPU = os.environ.get("SCRAPER_CPU")
 # Postman works great, but urllib and even my browser's string were
 # hanging... Whatever as long as we get HTML back!
 USER_AGENT = "PostmanRuntime/7.26.10"
+# Headers sent with every product page request, built once and shared.
+# Accept-Encoding is left to aiohttp, which asks for gzip and deflate (and
+# br when it can decode it) and decompresses the page transparently.
+HEADERS = {
+    "Accept": "*/*",
+    "Cache-Control": "no-cache",
+    "Host": 'www.bestbuy.com',
+    "User-Agent": USER_AGENT,
+}
 # Timeout (in seconds) for individual product page downloads
 TIMEOUT = 30
-# Regex for parsing the html
-RE_BUTTON_STATE = re.compile(r'"buttonState":"(.*?)"')
+# Connection pool settings for the shared HTTP session. Connections to
+# bestbuy are kept alive and DNS answers cached so later scrapes skip the
+# lookup and TLS handshake.
+LIMIT_PER_HOST = 8
+KEEPALIVE_TIMEOUT = 75
+DNS_CACHE_TTL = 300
+# Maximum number of product pages downloaded at once. Requests wait for a
+# slot before their timeout starts so a long product list doesn't time out
+# sitting in the connection pool queue.
+MAX_CONCURRENT_REQUESTS = LIMIT_PER_HOST
+# Marker preceding the add-to-cart button state in the product page html
+BUTTON_STATE_NEEDLE = b'"buttonState":"'
+# Longest button state we expect (e.g. ADD_TO_CART), anything longer means
+# the page isn't what we think it is
+BUTTON_STATE_MAX_LEN = 32
+# Size of the chunks (in bytes) product pages are streamed in
+CHUNK_SIZE = 65536
 # The table we use to track if notifications have been sent
 IN_STOCK_TABLE = "inStock"
 # Number of seconds we should stop sending notifications after a product
 # comes in stock
 IN_STOCK_EXP = 300
+# boto3 resources are expensive to build (service models are loaded and
+# parsed), so they're created on first use and shared across notifications
+_SNS = None
+_TABLE = None
+# In-process copy of the inStock expirations, keyed by (url, arn), so topics
+# we know are paused don't need a DynamoDB round-trip. This only pays off for
+# callers that run get_all_product_pages() repeatedly in one process (e.g. a
+# warm Lambda container). A single run of this script notifies each
+# (url, arn) at most once, so it never hits the cache.
+_NOTIFY_CACHE = {}
+# Shared HTTP session, reused across scrapes for the life of the process.
+# A session is tied to the event loop that created it, so a new one is made
+# whenever scrapes run on a different loop.
+_SESSION = None
+_SESSION_LOOP = None
+# boto3 calls block, so notifications are sent from a worker thread to keep
+# the event loop free. boto3 resources aren't thread safe, so a single
+# worker is used and notifications go out one at a time.
+NOTIFY_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+
+def get_aws_resources():
+    global _SNS, _TABLE
+    if _SNS is None:
+        _SNS = boto3.resource('sns')
+        _TABLE = boto3.resource('dynamodb').Table(IN_STOCK_TABLE)
+    return _SNS, _TABLE
+
+
+def pause_notifications(table, url, arn, now):
+    """Start a pause unless one is active, returns its expiration if started"""
+    expires = now + IN_STOCK_EXP
+    try:
+        table.put_item(
+            Item={"url": url, "arn": arn, "inStock": expires},
+            ConditionExpression=Attr("url").not_exists() | Attr("inStock").lt(now),
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        return None
+    return expires
 
 
 def notify(product):
     LOG.debug("notify(): %s", product["title"])
+    arn = None
     try:
-        sns = boto3.resource('sns')
-        ddb = boto3.resource('dynamodb')
-        table = ddb.Table(IN_STOCK_TABLE)
+        sns, table = get_aws_resources()
+        now = int(time.time())
         for arn in product["snsTopicArns"]:
-            item = table.get_item(
-                Key={"url": product["url"], "arn": arn}).get('Item')
-            if item is None:
+            key = (product["url"], arn)
+            diff = _NOTIFY_CACHE.get(key, 0) - now
+            if diff > 0:
+                LOG.debug("notifications paused for %s seconds: %s", diff, arn)
+                continue
+            expires = pause_notifications(table, product["url"], arn, now)
+            if expires is None:
+                LOG.debug("notifications paused: %s", arn)
+                continue
+            try:
                 topic = sns.Topic(arn)
                 topic.publish(
                     Subject="Your product is in stock at BestBuy!".format(product["title"]),
@@ -53,67 +141,124 @@ def notify(product):
                         product["url"],
                     ),
                 )
-                LOG.info("notification sent: %s, %s", arn, product["url"])
-                table.put_item(Item={
-                    "url": product["url"],
-                    "arn": arn,
-                    "inStock": int(datetime.datetime.now().timestamp()) + IN_STOCK_EXP,
-                })
-                LOG.debug("notifications paused for %s seconds: %s", IN_STOCK_EXP, arn)
-            else:
-                diff = item["inStock"] - int(datetime.datetime.now().timestamp())
-                LOG.debug("notifications paused for %s seconds: %s", diff, arn)
+            except Exception:
+                # release the pause so the next scrape tries again
+                table.delete_item(Key={"url": product["url"], "arn": arn})
+                raise
+            LOG.info("notification sent: %s, %s", arn, product["url"])
+            _NOTIFY_CACHE[key] = expires
+            LOG.debug("notifications paused for %s seconds: %s", IN_STOCK_EXP, arn)
     except Exception:
         LOG.exception("error sending notification: %s :: %s", arn, product["url"])
 
 
-async def get_product_page(session, product):
-    LOG.debug("get_product_page(): %s", product["title"])
+async def read_button_state(response):
+    """Stream the page looking for the button state, None if it isn't there"""
+    chunks = response.content.iter_chunked(CHUNK_SIZE)
+    button_state = None
+    buf = b""
+    async for chunk in chunks:
+        buf += chunk
+        start = buf.find(BUTTON_STATE_NEEDLE)
+        if start < 0:
+            # hang on to enough bytes to catch a needle split across chunks
+            buf = buf[-(len(BUTTON_STATE_NEEDLE) - 1):]
+            continue
+        start += len(BUTTON_STATE_NEEDLE)
+        end = buf.find(b'"', start, start + BUTTON_STATE_MAX_LEN + 1)
+        if end >= 0:
+            button_state = buf[start:end].decode("ascii", "ignore")
+            break
+        if len(buf) > start + BUTTON_STATE_MAX_LEN:
+            break
+        # the value continues in the next chunk
+        buf = buf[start - len(BUTTON_STATE_NEEDLE):]
+    # read and discard the rest of the body, leaving a response half read
+    # makes aiohttp close the connection instead of returning it to the pool
+    async for _ in chunks:
+        pass
+    return button_state
+
+
+async def get_product_page(session, semaphore, product):
     try:
-        async with session.get(
-            product["url"],
-            headers={
-                "Accept": "*/*",
-                "Cache-Control": "no-cache",
-                "Host": 'www.bestbuy.com',
-                "User-Agent": USER_AGENT,
-            },
-            timeout=aiohttp.ClientTimeout(total=TIMEOUT),
-        ) as response:
-            LOG.debug("downloaded: %s", product["url"])
-            html = await response.text()
-            match = RE_BUTTON_STATE.search(html)
-            if match:
-                button_state = match.group(1)
-                if button_state in ["ADD_TO_CART", "CHECK_STORES"]:
-                    LOG.info("product available (%s): %s", button_state, product["title"])
-                    notify(product)
-                else:
-                    LOG.info("product unavailable (%s): %s", button_state, product["title"])
+        LOG.debug("get_product_page(): %s", product["title"])
+        async with semaphore:
+            async with session.get(
+                product["url"],
+                headers=HEADERS,
+                timeout=aiohttp.ClientTimeout(total=TIMEOUT),
+            ) as response:
+                LOG.debug("downloading: %s", product["url"])
+                button_state = await read_button_state(response)
+        # notify after giving back the download slot and connection so other
+        # pages aren't stuck waiting behind the notification worker
+        if button_state is not None:
+            if button_state in ["ADD_TO_CART", "CHECK_STORES"]:
+                LOG.info("product available (%s): %s", button_state, product["title"])
+                await asyncio.get_running_loop().run_in_executor(
+                    NOTIFY_EXECUTOR, notify, product)
             else:
-                LOG.debug("button state not found: %s", product["title"])
+                LOG.info("product unavailable (%s): %s", button_state, product["title"])
+        else:
+            LOG.debug("button state not found: %s", product["title"])
     except asyncio.exceptions.TimeoutError:
-        LOG.warning('request timed out: %s', product["url"])
+        LOG.warning('request timed out: %s', product.get("url"))
+    except Exception:
+        LOG.exception("error checking product: %s", product.get("url"))
+
+
+def get_session():
+    global _SESSION, _SESSION_LOOP
+    loop = asyncio.get_running_loop()
+    if _SESSION is None or _SESSION.closed or _SESSION_LOOP is not loop:
+        _SESSION_LOOP = loop
+        _SESSION = aiohttp.ClientSession(connector=aiohttp.TCPConnector(
+            limit_per_host=LIMIT_PER_HOST,
+            keepalive_timeout=KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=DNS_CACHE_TTL,
+        ))
+    return _SESSION
+
+
+async def close_session():
+    global _SESSION, _SESSION_LOOP
+    if _SESSION is not None:
+        await _SESSION.close()
+        _SESSION = None
+        _SESSION_LOOP = None
 
 
 async def get_all_product_pages(products):
     LOG.debug("get_all_product_pages()")
-    async with aiohttp.ClientSession() as session:
-        tasks = []
+    session = get_session()
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    async with asyncio.TaskGroup() as tg:
         for product in products:
-            task = asyncio.ensure_future(get_product_page(session, product))
-            tasks.append(task)
-        await asyncio.gather(*tasks, return_exceptions=True)
+            tg.create_task(get_product_page(session, semaphore, product))
 
 
 if __name__ == '__main__':
     try:
-        with open(CONFIG_FILE) as fin:
-            config = json.load(fin)
+        with open(CONFIG_FILE, 'rb') as fin:
+            config = orjson.loads(fin.read()) if orjson else json.load(fin)
     except Exception as e:
         print(e)
         sys.exit(1)
-    loop = asyncio.new_event_loop()
+    if SCRAPER_CPU is not None and hasattr(os, "sched_setaffinity"):
+        try:
+            os.sched_setaffinity(0, {int(SCRAPER_CPU)})
+        except (ValueError, OSError):
+            LOG.warning("unable to pin to cpu: %s", SCRAPER_CPU)
+    # uvloop's libuv based loop is a faster drop-in for the default one
+    loop = uvloop.new_event_loop() if uvloop else asyncio.new_event_loop()
+    # start tasks eagerly so coroutines run up to their first real await
+    # without an extra trip through the event loop (Python 3.12+)
+    if hasattr(asyncio, "eager_task_factory"):
+        loop.set_task_factory(asyncio.eager_task_factory)
     asyncio.set_event_loop(loop)
-    asyncio.get_event_loop().run_until_complete(
-        get_all_product_pages(config["products"]))
+    try:
+        asyncio.get_event_loop().run_until_complete(
+            get_all_product_pages(config["products"]))
+    finally:
+        loop.run_until_complete(close_session())